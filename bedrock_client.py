@@ -0,0 +1,55 @@
+"""
+Shared Bedrock runtime client and model ID helpers
+"""
+import os
+import functools
+from typing import Optional
+import boto3
+from botocore.config import Config
+
+# Cross-region inference profile prefixes, keyed by the start of the region
+# name (GovCloud is checked before the commercial US regions)
+INFERENCE_PROFILE_PREFIXES = {'us-gov': 'us-gov', 'us': 'us', 'eu': 'eu', 'ap': 'apac'}
+
+# Models that have no cross-region inference profile in a geography
+MODELS_WITHOUT_PROFILE = {
+    'eu': {'anthropic.claude-3-5-haiku-20241022-v1:0'},
+    'apac': {'anthropic.claude-3-5-haiku-20241022-v1:0'},
+    'us-gov': {'anthropic.claude-3-5-haiku-20241022-v1:0'},
+}
+
+def _profile_prefix(region: str) -> Optional[str]:
+    """Return the inference profile prefix for a region, if it has one"""
+    for region_prefix, profile_prefix in INFERENCE_PROFILE_PREFIXES.items():
+        if region.startswith(f"{region_prefix}-"):
+            return profile_prefix
+    return None
+
+def has_inference_profile(model_id: str, region: str) -> bool:
+    """Whether a base Anthropic model ID has a cross-region profile for the region"""
+    prefix = _profile_prefix(region)
+    return (prefix is not None and model_id.startswith('anthropic.')
+            and model_id not in MODELS_WITHOUT_PROFILE.get(prefix, ()))
+
+def to_inference_profile(model_id: str, region: str) -> str:
+    """Map a base Anthropic model ID to its cross-region inference profile"""
+    if has_inference_profile(model_id, region):
+        return f"{_profile_prefix(region)}.{model_id}"
+    return model_id
+
+@functools.cache
+def get_bedrock_runtime(region: str):
+    """Return the process-wide bedrock-runtime client for a region"""
+    # Keep warm HTTPS connections around for concurrent Bedrock calls
+    return boto3.client(
+        'bedrock-runtime',
+        config=Config(
+            region_name=region,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            read_timeout=300
+        ),
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+    )
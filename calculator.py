@@ -0,0 +1,66 @@
+"""
+Arithmetic evaluator for the agents' calculate tool
+"""
+import ast
+import operator
+from functools import lru_cache
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+# Reject integer results (and powers that would produce them) above this many
+# bits, so nested powers can't grow into numbers too large to compute
+MAX_RESULT_BITS = 10_000
+
+class ResultError(ValueError):
+    """A valid expression whose result is too large or not a real number"""
+
+@lru_cache(maxsize=1024)
+def _parse(expression: str) -> ast.expr:
+    """Parse an expression once and reuse the tree on repeat calls"""
+    return ast.parse(expression.strip(), mode='eval').body
+
+def _evaluate(node: ast.expr):
+    """Walk the tree, allowing only numeric literals and arithmetic operators"""
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        left = _evaluate(node.left)
+        right = _evaluate(node.right)
+        # Skip obviously huge powers before computing them; the lower bound on
+        # the result size leaves the exact limit to the check below
+        if isinstance(node.op, ast.Pow) and isinstance(left, int) and isinstance(right, int) \
+                and right >= 0 and (abs(left).bit_length() - 1) * right > MAX_RESULT_BITS:
+            raise ResultError(f"Result of {ast.unparse(node)} is too large")
+        result = BINARY_OPERATORS[type(node.op)](left, right)
+        # A negative base with a fractional exponent gives a complex number
+        if isinstance(result, complex):
+            raise ResultError(f"Result of {ast.unparse(node)} is not a real number")
+        # Chains of * can also build up huge integers one step at a time
+        if isinstance(result, int) and result.bit_length() > MAX_RESULT_BITS:
+            raise ResultError(f"Result of {ast.unparse(node)} is too large")
+        return result
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+    raise ValueError(f"Unsupported expression: {ast.unparse(node)}")
+
+def evaluate(expression: str):
+    """Evaluate a basic arithmetic expression without eval()
+
+    Supports numbers, parentheses and + - * / // % ** operators. Raises
+    ResultError for results that are too large or complex, ValueError for
+    anything else and SyntaxError for malformed input.
+    """
+    return _evaluate(_parse(expression))
@@ -0,0 +1,82 @@
+"""
+Two-tier response cache for Bedrock model calls
+"""
+import hashlib
+import math
+from typing import Optional
+
+class ResponseCache:
+    """Cache model responses by exact input hash, with an optional embedding-similarity tier.
+
+    Entries are keyed on (model_id, sha256(normalized input)) and evicted
+    least-frequently-used first once the cache is full.
+    """
+
+    def __init__(self, capacity: int = 50_000, semantic_capacity: int = 1_000,
+                 similarity_threshold: float = 0.95):
+        self.capacity = capacity
+        # The similarity tier is a linear scan, so it is kept much smaller
+        # than the exact tier to stay in the millisecond range
+        self.semantic_capacity = semantic_capacity
+        self.similarity_threshold = similarity_threshold
+        self._responses: dict[tuple[str, str], str] = {}
+        self._hits: dict[tuple[str, str], int] = {}
+        self._embeddings: dict[tuple[str, str], list[float]] = {}
+
+    @staticmethod
+    def key(model_id: str, text: str) -> tuple[str, str]:
+        """Build the cache key for an input"""
+        digest = hashlib.sha256(text.strip().lower().encode()).hexdigest()
+        return (model_id, digest)
+
+    def get(self, key: tuple[str, str]) -> Optional[str]:
+        """Return the cached response for an exact key match"""
+        response = self._responses.get(key)
+        if response is not None:
+            self._hits[key] += 1
+        return response
+
+    def get_similar(self, model_id: str, embedding: list[float]) -> Optional[str]:
+        """Return the cached response whose input embedding is closest, if above the threshold"""
+        query = _normalize(embedding)
+        best_key, best_score = None, self.similarity_threshold
+        for key, vector in self._embeddings.items():
+            # Only compare against entries produced by the same model
+            if key[0] != model_id:
+                continue
+            score = sum(a * b for a, b in zip(query, vector))
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        if best_key is None:
+            return None
+        return self.get(best_key)
+
+    def put(self, key: tuple[str, str], response: str, embedding: Optional[list[float]] = None):
+        """Store a response, evicting the least frequently used entry when full"""
+        if key not in self._responses and len(self._responses) >= self.capacity:
+            self._evict(self._responses)
+
+        self._responses[key] = response
+        self._hits.setdefault(key, 0)
+
+        if embedding is not None:
+            if key not in self._embeddings and len(self._embeddings) >= self.semantic_capacity:
+                self._evict(self._embeddings)
+            self._embeddings[key] = _normalize(embedding)
+
+    def _evict(self, entries: dict):
+        """Drop the least frequently used key from the given tier"""
+        victim = min(entries, key=lambda k: self._hits.get(k, 0))
+        if entries is self._responses:
+            self._responses.pop(victim, None)
+            self._hits.pop(victim, None)
+        self._embeddings.pop(victim, None)
+
+    def __len__(self):
+        return len(self._responses)
+
+def _normalize(vector: list[float]) -> list[float]:
+    """Scale a vector to unit length so cosine similarity is a dot product"""
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
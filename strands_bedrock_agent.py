@@ -2,75 +2,87 @@
 Hello World Strands Agent with AWS Bedrock and Braintrust OpenTelemetry
 """
 import os
-import json
+import asyncio
 from typing import Optional, Any
 from dotenv import load_dotenv
-import boto3
-from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Prefer orjson for the request/response hot path when it is installed
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 from strands import Agent
 from strands.models import Model
 from strands.telemetry import StrandsTelemetry
+from strands.tools import convert_pydantic_to_tool_spec
+from strands.types.exceptions import ModelThrottledException
 from strands import tool
 
+from bedrock_client import get_bedrock_runtime, to_inference_profile
+from calculator import evaluate
+
 load_dotenv()
 
+BEDROCK_MODEL_ID = os.getenv('BEDROCK_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+
 class BedrockModel(Model):
     """Custom AWS Bedrock model for Strands SDK"""
     
-    def __init__(self, model_id: str = None, region: str = 'us-east-1'):
+    def __init__(self, model_id: str = None, region: str = 'us-east-1', tools=None,
+                 max_tokens: int = 256):
         super().__init__()
-        self.bedrock_runtime = boto3.client(
-            'bedrock-runtime',
-            region_name=region,
-            config=Config(read_timeout=300, retries={'max_attempts': 3}),
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-        )
-        
-        # Handle model selection - use models that work with on-demand throughput
-        if model_id and 'sonnet-4' in model_id:
-            # Claude Sonnet 4 requires inference profile, fall back to Sonnet 3
-            self.model_id = 'anthropic.claude-3-sonnet-20240229-v1:0'
-            print(f"Using fallback model: {self.model_id}")
-        elif model_id:
-            self.model_id = model_id
-        else:
-            self.model_id = os.getenv('BEDROCK_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+        self.bedrock_runtime = get_bedrock_runtime(region)
+        
+        # Handle model selection - invoke through a cross-region inference profile
+        # so Bedrock can route around per-region throttling
+        if not model_id:
+            model_id = BEDROCK_MODEL_ID
+        self.model_id = to_inference_profile(model_id, region)
         
         print(f"Initialized Bedrock model: {self.model_id}")
+        # Generation time scales with output tokens, so keep the default cap tight
+        self.max_tokens = max_tokens
         self.config = {"model_id": self.model_id, "region": region}
+        
+        # The tool set rarely changes for an agent, so serialize it up front
+        self._tool_definitions_cache = {}
+        if tools:
+            self._tool_definitions([getattr(t, 'tool_spec', t) for t in tools])
     
-    def __call__(self, messages, tools=None, **kwargs):
-        """Run inference using AWS Bedrock"""
-        # Convert messages to Bedrock format
-        bedrock_messages = []
-        system_prompt = None
-        
-        for msg in messages:
-            if hasattr(msg, 'role') and hasattr(msg, 'content'):
-                if msg.role == "system":
-                    system_prompt = msg.content
-                else:
-                    bedrock_messages.append({
-                        "role": msg.role,
-                        "content": msg.content if isinstance(msg.content, str) else str(msg.content)
-                    })
-            else:
-                # Handle dict messages
-                if msg.get('role') == 'system':
-                    system_prompt = msg.get('content', '')
-                else:
-                    bedrock_messages.append({
-                        "role": msg.get('role', 'user'),
-                        "content": msg.get('content', '')
-                    })
+    def _build_request_body(self, messages, tools=None, system_prompt=None, **kwargs):
+        """Build the Claude request body for Bedrock"""
+        # Convert messages to Bedrock format; messages within a call share one type
+        messages = list(messages)
+        is_dict = isinstance(messages[0], dict) if messages else False
+        
+        if is_dict:
+            bedrock_messages = [
+                {"role": m.get('role', 'user'), "content": _format_content(m.get('content', ''))}
+                for m in messages if m.get('role') != 'system'
+            ]
+            system_prompts = [m.get('content', '') for m in messages if m.get('role') == 'system']
+        else:
+            bedrock_messages = [
+                {"role": m.role, "content": m.content if isinstance(m.content, str) else str(m.content)}
+                for m in messages if m.role != 'system'
+            ]
+            system_prompts = [m.content for m in messages if m.role == 'system']
+        
+        # A system message in the conversation takes precedence over the argument
+        if system_prompts:
+            system_prompt = system_prompts[-1]
         
         # Prepare the request body for Claude models
         body = {
             "anthropic_version": "bedrock-2023-05-31",
             "messages": bedrock_messages,
-            "max_tokens": kwargs.get("max_tokens", 1024),
+            "max_tokens": kwargs.get("max_tokens", self.max_tokens),
             "temperature": kwargs.get("temperature", 0.7)
         }
         
@@ -79,58 +91,64 @@ class BedrockModel(Model):
         
         # Add tools if provided
         if tools:
-            tool_definitions = []
-            for t in tools:
-                if hasattr(t, '__tool_metadata__'):
-                    # Extract tool metadata
-                    tool_def = {
-                        "name": t.__tool_metadata__.get('name', t.__name__),
-                        "description": t.__tool_metadata__.get('description', ''),
-                        "input_schema": {
-                            "type": "object",
-                            "properties": t.__tool_metadata__.get('parameters', {}),
-                            "required": t.__tool_metadata__.get('required', [])
-                        }
-                    }
-                    tool_definitions.append(tool_def)
-            
+            tool_definitions = self._tool_definitions(tools)
             if tool_definitions:
                 body["tools"] = tool_definitions
+            if kwargs.get("tool_choice"):
+                body["tool_choice"] = kwargs["tool_choice"]
         
-        try:
-            response = self.bedrock_runtime.invoke_model(
-                modelId=self.model_id,
-                contentType='application/json',
-                accept='application/json',
-                body=json.dumps(body)
-            )
-            
-            response_body = json.loads(response['body'].read())
-            
-            # Extract the response content
-            content = response_body.get('content', [])
-            if content and len(content) > 0:
-                # Check if there's a tool use request
-                for item in content:
-                    if item.get('type') == 'tool_use':
-                        # Return tool call information
-                        return {
-                            'content': '',
-                            'tool_calls': [{
-                                'name': item.get('name'),
-                                'arguments': item.get('input', {})
-                            }]
-                        }
-                
-                # Regular text response
-                text = content[0].get('text', '')
-                return {'content': text}
-            
-            return {'content': ''}
-            
-        except Exception as e:
-            print(f"Error calling Bedrock: {e}")
-            return {'content': f"Error: {str(e)}"}
+        return body
+    
+    def _tool_definitions(self, tool_specs):
+        """Return Bedrock tool definitions, converted once per distinct tool set"""
+        key = tuple(spec['name'] for spec in tool_specs)
+        tool_definitions = self._tool_definitions_cache.get(key)
+        if tool_definitions is None:
+            # Strands passes ToolSpec dicts; Anthropic's messages API wants the
+            # JSON schema directly under input_schema
+            tool_definitions = [
+                {
+                    "name": spec['name'],
+                    "description": spec.get('description', ''),
+                    "input_schema": spec['inputSchema']['json'],
+                }
+                for spec in tool_specs
+            ]
+            self._tool_definitions_cache[key] = tool_definitions
+        return tool_definitions
+    
+    def __call__(self, messages, tools=None, **kwargs):
+        """Run inference using AWS Bedrock from synchronous code, collecting the streamed response"""
+        return asyncio.run(self._collect(self.stream(messages, tools, **kwargs)))
+    
+    @staticmethod
+    async def _collect(events):
+        """Fold stream events into {'content': ...} or {'content': '', 'tool_calls': [...]}"""
+        text = []
+        tool_calls = []
+        tool_input = None
+        async for event in events:
+            if 'contentBlockStart' in event:
+                tool_use = event['contentBlockStart'].get('start', {}).get('toolUse')
+                if tool_use:
+                    tool_calls.append({'name': tool_use['name'], 'arguments': {}})
+                    tool_input = []
+            elif 'contentBlockDelta' in event:
+                delta = event['contentBlockDelta']['delta']
+                if 'text' in delta:
+                    text.append(delta['text'])
+                elif 'toolUse' in delta and tool_input is not None:
+                    tool_input.append(delta['toolUse']['input'])
+            elif 'contentBlockStop' in event and tool_input is not None:
+                # Tool arguments arrive as JSON fragments; tools without arguments send none
+                arguments = ''.join(tool_input)
+                tool_calls[-1]['arguments'] = json_loads(arguments) if arguments else {}
+                tool_input = None
+        
+        if tool_calls:
+            # Return tool call information
+            return {'content': '', 'tool_calls': tool_calls}
+        return {'content': ''.join(text)}
     
     def get_config(self):
         """Return model configuration"""
@@ -140,19 +158,126 @@ class BedrockModel(Model):
         """Update model configuration"""
         self.config.update(kwargs)
     
-    def stream(self, messages, tools=None, system_prompt=None, **kwargs):
-        """Stream responses (not implemented for this example)"""
-        # For simplicity, just return the full response
-        if system_prompt:
-            # Add system prompt to messages if provided
-            messages = [{"role": "system", "content": system_prompt}] + list(messages)
-        result = self.__call__(messages, tools, **kwargs)
-        yield result
-    
-    def structured_output(self, messages, schema, **kwargs):
-        """Get structured output (not implemented for this example)"""
-        # For simplicity, just return regular output
-        return self.__call__(messages, **kwargs)
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs):
+        """Stream a response from AWS Bedrock as Strands stream events"""
+        body = self._build_request_body(messages, tool_specs, system_prompt, **kwargs)
+        
+        try:
+            # boto3 is synchronous, so make the call and read events in worker threads
+            response = await asyncio.to_thread(
+                self.bedrock_runtime.invoke_model_with_response_stream,
+                modelId=self.model_id,
+                contentType='application/json',
+                accept='application/json',
+                body=json_dumps(body)
+            )
+        except ClientError as e:
+            _raise_if_throttled(e)
+            raise
+        
+        events = iter(response['body'])
+        usage = {'inputTokens': 0, 'outputTokens': 0, 'totalTokens': 0}
+        latency_ms = 0
+        stop_reason = 'end_turn'
+        
+        while True:
+            try:
+                event = await asyncio.to_thread(next, events, None)
+            except ClientError as e:
+                # Mid-stream exception frames are raised by botocore as EventStreamError
+                _raise_if_throttled(e)
+                raise
+            if event is None:
+                break
+            
+            chunk = json_loads(event['chunk']['bytes'])
+            chunk_type = chunk.get('type')
+            index = chunk.get('index')
+            
+            if chunk_type == 'message_start':
+                usage['inputTokens'] = chunk.get('message', {}).get('usage', {}).get('input_tokens', 0)
+                yield {'messageStart': {'role': 'assistant'}}
+            elif chunk_type == 'content_block_start':
+                block = chunk.get('content_block', {})
+                start = {}
+                if block.get('type') == 'tool_use':
+                    start = {'toolUse': {'toolUseId': block.get('id'), 'name': block.get('name')}}
+                yield {'contentBlockStart': {'contentBlockIndex': index, 'start': start}}
+            elif chunk_type == 'content_block_delta':
+                delta = chunk.get('delta', {})
+                if delta.get('type') == 'text_delta':
+                    yield {'contentBlockDelta': {'contentBlockIndex': index, 'delta': {'text': delta.get('text', '')}}}
+                elif delta.get('type') == 'input_json_delta':
+                    yield {'contentBlockDelta': {
+                        'contentBlockIndex': index,
+                        'delta': {'toolUse': {'input': delta.get('partial_json', '')}}
+                    }}
+            elif chunk_type == 'content_block_stop':
+                yield {'contentBlockStop': {'contentBlockIndex': index}}
+            elif chunk_type == 'message_delta':
+                stop_reason = chunk.get('delta', {}).get('stop_reason') or stop_reason
+                usage['outputTokens'] = chunk.get('usage', {}).get('output_tokens', 0)
+            elif chunk_type == 'message_stop':
+                latency_ms = chunk.get('amazon-bedrock-invocationMetrics', {}).get('invocationLatency', 0)
+                yield {'messageStop': {'stopReason': stop_reason}}
+        
+        usage['totalTokens'] = usage['inputTokens'] + usage['outputTokens']
+        yield {'metadata': {'usage': usage, 'metrics': {'latencyMs': latency_ms}}}
+    
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        """Get structured output by forcing a tool call shaped like the output model"""
+        tool_spec = convert_pydantic_to_tool_spec(output_model)
+        result = await self._collect(self.stream(
+            prompt,
+            [tool_spec],
+            system_prompt,
+            tool_choice={'type': 'tool', 'name': tool_spec['name']},
+            **kwargs
+        ))
+        
+        if not result.get('tool_calls'):
+            raise ValueError("Model did not return structured output")
+        yield {'output': output_model(**result['tool_calls'][0]['arguments'])}
+
+def _raise_if_throttled(error: ClientError):
+    """Re-raise a Bedrock throttling error as the exception Strands retries on"""
+    if error.response.get('Error', {}).get('Code') in ('ThrottlingException', 'throttlingException'):
+        raise ModelThrottledException(str(error)) from error
+
+def _format_content(content):
+    """Convert Strands content blocks to Claude messages content"""
+    if isinstance(content, str):
+        return content
+    
+    formatted = []
+    for block in content:
+        if 'text' in block:
+            formatted.append({'type': 'text', 'text': block['text']})
+        elif 'toolUse' in block:
+            tool_use = block['toolUse']
+            formatted.append({
+                'type': 'tool_use',
+                'id': tool_use['toolUseId'],
+                'name': tool_use['name'],
+                'input': tool_use['input']
+            })
+        elif 'toolResult' in block:
+            tool_result = block['toolResult']
+            formatted.append({
+                'type': 'tool_result',
+                'tool_use_id': tool_result['toolUseId'],
+                'content': [
+                    {'type': 'text', 'text': item['text'] if 'text' in item else _json_text(item.get('json'))}
+                    for item in tool_result.get('content', [])
+                ],
+                'is_error': tool_result.get('status') == 'error'
+            })
+    return formatted
+
+def _json_text(value) -> str:
+    """Serialize a JSON tool result to text with whichever codec is installed"""
+    data = json_dumps(value)
+    return data.decode() if isinstance(data, bytes) else data
 
 # Define some simple tools for the agent
 @tool(description="Get the current weather for a location")
@@ -164,7 +289,7 @@ def get_weather(location: str) -> str:
 def calculate(expression: str) -> str:
     """Evaluate a mathematical expression"""
     try:
-        result = eval(expression, {"__builtins__": {}}, {})
+        result = evaluate(expression)
         return f"The result of {expression} is {result}"
     except Exception as e:
         return f"Error calculating {expression}: {str(e)}"
@@ -192,8 +317,10 @@ def create_strands_agent_with_telemetry():
         telemetry.setup_console_exporter()
         print("Using console telemetry (no Braintrust API key found)")
     
+    tools = [get_weather, calculate]
+    
     # Create the Bedrock model
-    bedrock_model = BedrockModel()
+    bedrock_model = BedrockModel(tools=tools)
     
     # Create the agent
     agent = Agent(
@@ -203,7 +330,7 @@ def create_strands_agent_with_telemetry():
         system_prompt="""You are a helpful AI assistant built with the Strands SDK and powered by AWS Bedrock. 
         You have access to tools for weather information and calculations.
         Be concise and friendly in your responses.""",
-        tools=[get_weather, calculate],
+        tools=tools,
         trace_attributes={
             "agent.type": "strands",
             "llm.provider": "aws_bedrock",
@@ -246,5 +373,4 @@ async def main():
     print("=" * 60)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
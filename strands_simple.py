@@ -8,8 +8,13 @@ from strands import Agent
 from strands.models import BedrockModel
 from strands import tool
 
+from calculator import ResultError, evaluate
+
 load_dotenv()
 
+AWS_REGION = os.getenv('AWS_REGION', 'us-east-1')
+BEDROCK_MODEL_ID = os.getenv('BEDROCK_MODEL_ID')
+
 # Define some tools for the agent
 @tool(description="Get the current weather for a location")
 def get_weather(location: str) -> str:
@@ -21,12 +26,12 @@ def calculate(expression: str) -> str:
     """Evaluate a mathematical expression safely"""
     try:
         # Only allow basic math operations
-        allowed = set("0123456789+-*/()., ")
-        if all(c in allowed for c in expression):
-            result = eval(expression, {"__builtins__": {}}, {})
-            return f"The result is: {result}"
-        else:
-            return "Invalid expression. Only basic math operations are allowed."
+        result = evaluate(expression)
+        return f"The result is: {result}"
+    except ResultError as e:
+        return f"Error: {str(e)}"
+    except ValueError:
+        return "Invalid expression. Only basic math operations are allowed."
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -59,12 +64,12 @@ async def main():
     telemetry = setup_braintrust_telemetry()
     
     # Get model ID from environment or use default
-    model_id = os.getenv('BEDROCK_MODEL_ID')
+    model_id = BEDROCK_MODEL_ID
     
     # Create Bedrock model
     bedrock_model = BedrockModel(
         model_id=model_id,
-        region=os.getenv('AWS_REGION', 'us-east-1')
+        region=AWS_REGION
     )
     
     # Create the agent